@@ -10,10 +10,13 @@ parser.add_argument('--kmer_length', '-l', required=True, metavar='kmer_length',
                     help="Length of the k-mers")  #K-mer length
 parser.add_argument('--outfile', '-o', required=True, metavar='output_file',
                     help="Output file for the json dictionary")  # Output file
+parser.add_argument('--packed_prefix', '-p', required=False, metavar='packed_prefix',
+                    help="Also write a 2-bit packed copy of the reference to packed_prefix.2bit, with its index in packed_prefix.2bit.json")  # Packed reference
 
 args = parser.parse_args()
 
 import json
+import refine
 
 def reverse_complement(testcase):
     reverse=""
@@ -153,4 +156,11 @@ while testcase!="":
     line+=1
 #The dictionary is dumped to the given json file
 with open(args.outfile, "w") as outfile:
-    json.dump(dictionary, outfile)
\ No newline at end of file
+    json.dump(dictionary, outfile)
+#If asked for, a 2-bit packed copy of the reference is written so that kmer_finder.py can refine the splits it finds.
+if args.packed_prefix:
+    try:
+        refine.write_packed(args.infile, args.packed_prefix, kmer_length, len(dictionary), strandcounter+1)
+    except (OSError, ValueError) as err:
+        print("Could not write packed reference: {e}".format(e=err))
+        exit(1)
@@ -4,6 +4,7 @@
 import argparse
 import valet
 import json
+import refine
 
 parser = argparse.ArgumentParser(description="Finds k-mers of a given length in a fasta file, prints out a dictionary with the first 5 k-mers in the DNA sequence")
 parser.add_argument('--fastq_file', '-f', required=True, metavar='fastq_file',
@@ -14,6 +15,8 @@ parser.add_argument('--kmer_length', '-l', required=True, metavar='kmer_length',
                     help="Length of the k-mers, should be the same as kmer_dict.py")  #K-mer length
 parser.add_argument('--out_file', '-o', required=True, metavar='out_file',
                     help="Output json file")  #Output file
+parser.add_argument('--packed_prefix', '-p', required=False, metavar='packed_prefix',
+                    help="Prefix of the packed reference written by kmer_dict.py, used to refine the splits to base-pair breakpoints")  #Packed reference
 
 args = parser.parse_args()
 
@@ -75,6 +78,8 @@ line=f.readline().strip()
 #The max match list is the highest number that can be achieved if every k-mer in a single fastq line matched a value from the dictionary.
 max_match_list_len=len(line)-kmer_length
 extrema_dict={}
+#The reads that add to the extrema of a sequence are kept, along with the span of their matches, so that the splits can be refined.
+split_reads_dict={}
 #This variable tracks the splits that span multiple sequences on the fasta file.
 intersequence_list=[]
 #This loop runs to the end of the file
@@ -82,6 +87,9 @@ while line!="":
     #The match list is reset for each reference sequence.
     match_list=[]
     no_match_counter=0
+    #The read offsets of the first and last matching k-mers are kept so that the ends of the read can be placed on the reference.
+    first_match=None
+    last_match=None
     for number in range(len(line)-kmer_length+1):
         #The k_mer variable is created and set to start at number with length kmer_length
         k_mer=line[number:number+kmer_length]
@@ -91,6 +99,9 @@ while line!="":
         #The k_mer is converted to a number
         k_mer=to_number(k_mer)
         if str(k_mer) in dictionary:
+            if first_match==None:
+                first_match=number
+            last_match=number
             for list in dictionary[str(k_mer)]:
                 #The sequence number is set as sequence_counter and each value of the list is appended as a tuple to match_list
                 sequence_counter=list[0]
@@ -120,6 +131,15 @@ while line!="":
             if difference<(predicted_split_length*2) and difference>(predicted_split_length/2):
                 #A list containing the extrema is made, and any value who is not consecutive on both sides of the value will be added.
                 counter=0
+                if args.packed_prefix:
+                    #The -1 that kmer_dict.py adds after the 5th position of a k-mer is not a position, so it is left out of the span of the read.
+                    match_positions=[position for position in match_list if position!=-1]
+                    #The number of bases before the first matching k-mer and after the last one are stored with the span of the matches.
+                    supporting_read=(line,match_positions[0],match_positions[-1]+kmer_length,first_match,len(line)-last_match-kmer_length)
+                    if split_reads_dict.get(sequence)==None:
+                        split_reads_dict[sequence]=[supporting_read]
+                    else:
+                        split_reads_dict[sequence].append(supporting_read)
                 #This loop runs until the end of the match_list. A while loop is used so that the difference between a position and the next position can be found
                 while counter<len(match_list)-2:
                     if match_list[counter+1]-match_list[counter]!=1:
@@ -154,6 +174,13 @@ while line!="":
 
 #The final dictionary contianing all the important variables is made.
 final_dict={}
+#The packed reference is only opened if the splits are going to be refined.
+if args.packed_prefix:
+    try:
+        reference=refine.open_packed(args.packed_prefix,dictionary,kmer_length)
+    except (OSError, ValueError) as err:
+        print("Could not open packed reference: {e}".format(e=err))
+        exit(1)
 if intersequence_list:
     final_dict['intersequence_list'] = intersequence_list
 for sequence in extrema_dict:
@@ -163,6 +190,8 @@ for sequence in extrema_dict:
     final_dict["extrema_list"+str(sequence)]=extrema_list
     poisswin_list=valet.poisswin(extrema_list,extrema_list[-1])
     final_dict["poisswin_list"+str(sequence)]=poisswin_list
+    #Different windows can end up with the same best split, so each split is only refined once per sequence.
+    refined_dict={}
     for poisswin_dict in poisswin_list:
         #The best end must be less than the length of the extrema list to avoid an index error.
         if poisswin_dict['be']<len(extrema_list):
@@ -177,6 +206,16 @@ for sequence in extrema_dict:
             final_dict["best_split"+str(sequence)]=[(best_start,best_end)]
         else:
             final_dict["best_split"+str(sequence)].append((best_start,best_end))
+        #The split is refined to base-pair breakpoints using the packed reference and the reads that support it.
+        #None is stored when it cannot be refined so that each refined split stays at the same position as its best split.
+        if args.packed_prefix:
+            if (best_start,best_end) not in refined_dict:
+                refined_dict[(best_start,best_end)]=refine.refine_split(reference,sequence,best_start,best_end,split_reads_dict.get(sequence,[]))
+            refined_split=refined_dict[(best_start,best_end)]
+            if final_dict.get("refined_split"+str(sequence))==None:
+                final_dict["refined_split"+str(sequence)]=[refined_split]
+            else:
+                final_dict["refined_split"+str(sequence)].append(refined_split)
 
 #The final dictionary is printed and also dumped into the given json out_file.
 print(final_dict)
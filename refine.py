@@ -0,0 +1,392 @@
+###########################
+## refine.py
+##
+## Module that contains helper functions for storing reference sequences
+## in a 2-bit packed form and for refining split coordinates to base-pair
+## breakpoints using the reads that support them
+###########################
+import json
+import mmap
+
+## Bases are packed with the same 2-bit encoding used by to_number()
+ENCODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+DECODE = 'ACGT'
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+def reverse_complement(sequence):
+    """
+    NAME: reverse_complement()
+
+    PURPOSE:
+        Returns the reverse complement of a DNA sequence. Unlike the version in kmer_dict.py
+        any base that is not A, C, G or T is kept as an N so that read positions do not shift.
+
+    :param sequence: The DNA sequence
+    :type sequence: string
+    :return: The reverse complement of the DNA sequence
+    :rtype: string
+    """
+    reverse = ""
+    for letter in sequence[::-1]:
+        reverse += COMPLEMENT.get(letter, 'N')
+    return reverse
+
+#################################
+def write_packed(fasta_file, prefix, kmer_length, kmers, records):
+    """
+    NAME: write_packed()
+
+    PURPOSE:
+        Reads every record of a FASTA file and writes a 2-bit packed copy of it to
+        prefix.2bit (four bases per byte, first base in the high bits) along with an
+        index in prefix.2bit.json. Each record starts on a byte boundary, and runs of
+        any base that is not A, C, G or T are stored in the index as [start, end) pairs
+        so they can be restored as N when the sequence is read back.
+
+        Records are numbered from 0 the same way kmer_dict.py numbers its strands, with
+        the first line always starting record 0. kmer_dict.py reads a header directly after
+        another header (other than the first line), or a blank line followed by sequence,
+        as a line of sequence, which shifts its positions for the rest of the record. Such
+        files are rejected instead of being packed with positions that do not match. The
+        k-mer length and number of k-mers of the dictionary are saved in the index so
+        open_packed() can check that the two belong together.
+
+    :param fasta_file: The FASTA file containing the reference sequences
+    :type fasta_file: string
+    :param prefix: Prefix of the packed file and its index
+    :type prefix: string
+    :param kmer_length: Length of the k-mers in the dictionary made from the same file
+    :type kmer_length: int
+    :param kmers: Number of k-mers in the dictionary made from the same file
+    :type kmers: int
+    :param records: Number of records kmer_dict.py found in the same file
+    :type records: int
+    :return: The index that was written
+    :rtype: dict
+    """
+    index = {'kmer_length': kmer_length, 'kmers': kmers, 'records': {}}
+    record = None
+    offset = 0
+    last_header = False
+    blank_line = False
+    with open(fasta_file, "r") as f, open(prefix + ".2bit", "wb") as out:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                blank_line = True
+                continue
+            if blank_line and line[0] != ">":
+                raise ValueError("write_packed: blank line before line {n} of {f} would shift the positions kmer_dict.py finds".format(
+                    n=line_number, f=fasta_file))
+            blank_line = False
+            if record is None or line[0] == ">":
+                if record is not None and last_header:
+                    raise ValueError("write_packed: header on line {n} of {f} follows another header, which would shift the positions kmer_dict.py finds".format(
+                        n=line_number, f=fasta_file))
+                if record is not None:
+                    offset += _finish_record(out, record)
+                    index['records'][str(len(index['records']))] = record['entry']
+                record = {'entry': {'name': line.lstrip(">"), 'offset': offset, 'length': 0, 'n_runs': []},
+                          'pending': []}
+                # The first line is always taken as a header, so a header right after it still counts
+                last_header = len(index['records']) > 0
+                continue
+            last_header = False
+            _add_bases(out, record, line.upper())
+        if record is not None:
+            _finish_record(out, record)
+            index['records'][str(len(index['records']))] = record['entry']
+
+    if len(index['records']) != records:
+        raise ValueError("write_packed: found {n} records in {f} but kmer_dict.py found {r}".format(
+            n=len(index['records']), f=fasta_file, r=records))
+
+    with open(prefix + ".2bit.json", "w") as index_file:
+        json.dump(index, index_file)
+    return index
+
+def _add_bases(out, record, bases):
+    """
+    NAME: _add_bases()
+
+    PURPOSE:
+        Appends bases to the record currently being written, packing every complete
+        group of four bases straight to the output file and extending the N runs.
+
+    :param out: The packed output file
+    :type out: file
+    :param record: The record being written
+    :type record: dict
+    :param bases: The bases to append
+    :type bases: string
+    """
+    entry = record['entry']
+    pending = record['pending']
+    packed = bytearray()
+    for letter in bases:
+        code = ENCODE.get(letter)
+        if code is None:
+            runs = entry['n_runs']
+            if runs and runs[-1][1] == entry['length']:
+                runs[-1][1] += 1
+            else:
+                runs.append([entry['length'], entry['length'] + 1])
+            code = 0
+        pending.append(code)
+        entry['length'] += 1
+        if len(pending) == 4:
+            packed.append(pending[0] << 6 | pending[1] << 4 | pending[2] << 2 | pending[3])
+            del pending[:]
+    out.write(packed)
+
+def _finish_record(out, record):
+    """
+    NAME: _finish_record()
+
+    PURPOSE:
+        Pads and writes the last partial byte of a record.
+
+    :param out: The packed output file
+    :type out: file
+    :param record: The record being finished
+    :type record: dict
+    :return: The number of bytes the record takes up in the packed file
+    :rtype: int
+    """
+    pending = record['pending']
+    if pending:
+        byte = 0
+        for position in range(4):
+            byte <<= 2
+            if position < len(pending):
+                byte |= pending[position]
+        out.write(bytes([byte]))
+        del pending[:]
+    return (record['entry']['length'] + 3) // 4
+
+#################################
+def open_packed(prefix, dictionary, kmer_length):
+    """
+    NAME: open_packed()
+
+    PURPOSE:
+        Opens a reference written by write_packed(). The packed file is memory mapped,
+        so only the pages around the regions that are fetched are ever read from disk.
+        The k-mer length and number of k-mers saved in the index must match the
+        dictionary being used, otherwise the packed reference was made from another file.
+
+    :param prefix: Prefix of the packed file and its index
+    :type prefix: string
+    :param dictionary: The k-mer dictionary created by kmer_dict.py
+    :type dictionary: dict
+    :param kmer_length: Length of the k-mers in the dictionary
+    :type kmer_length: int
+    :return: A tuple containing the index and the memory map of the packed file
+    :rtype: tuple
+    """
+    with open(prefix + ".2bit.json") as index_file:
+        index = json.load(index_file)
+    if index.get('kmer_length') != kmer_length or index.get('kmers') != len(dictionary):
+        raise ValueError("open_packed: {p}.2bit was not made from the same reference as the k-mer dictionary".format(p=prefix))
+    with open(prefix + ".2bit", "rb") as f:
+        if f.seek(0, 2) == 0: # an empty file cannot be mapped
+            return index, b""
+        packed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return index, packed
+
+def fetch(reference, record, start, end):
+    """
+    NAME: fetch()
+
+    PURPOSE:
+        Decodes bases [start, end) of a record from a reference opened by open_packed().
+        The region is clipped to the record and positions in an N run come back as N.
+
+    :param reference: The tuple returned by open_packed()
+    :type reference: tuple
+    :param record: The record number, as used by kmer_dict.py
+    :type record: int
+    :param start: First base of the region
+    :type start: int
+    :param end: One past the last base of the region
+    :type end: int
+    :return: The bases of the region
+    :rtype: string
+    """
+    index, packed = reference
+    entry = index['records'][str(record)]
+    start = max(start, 0)
+    end = min(end, entry['length'])
+    if start >= end:
+        return ""
+
+    first_byte = entry['offset'] + start // 4
+    data = packed[first_byte:entry['offset'] + (end + 3) // 4]
+    bases = []
+    for byte in data:
+        bases.append(DECODE[byte >> 6] + DECODE[byte >> 4 & 3] + DECODE[byte >> 2 & 3] + DECODE[byte & 3])
+    skip = start % 4
+    sequence = list("".join(bases)[skip:skip + end - start])
+
+    for run_start, run_end in entry['n_runs']:
+        if run_end <= start or run_start >= end:
+            continue
+        for position in range(max(run_start, start), min(run_end, end)):
+            sequence[position - start] = 'N'
+    return "".join(sequence)
+
+#################################
+def _best_ends(read, window, diagonal, band, match=2, mismatch=-3, gap=-5):
+    """
+    NAME: _best_ends()
+
+    PURPOSE:
+        Banded local alignment of a read against a reference window. Only the cells
+        within band of the diagonal (window position = read position + diagonal) are
+        computed. For every read position it returns the best score of an alignment
+        ending right after that read position, and the window position where it ends.
+
+    :param read: The read
+    :type read: string
+    :param window: The reference window
+    :type window: string
+    :param diagonal: Offset of the expected diagonal within the window
+    :type diagonal: int
+    :param band: Number of cells computed on each side of the diagonal
+    :type band: int
+    :return: A list with a (score, window end) tuple for each read prefix length
+    :rtype: list
+    """
+    best = [(0, None)]
+    previous = {}
+    for i in range(1, len(read) + 1):
+        current = {}
+        row_best = (0, None)
+        low = max(i + diagonal - band, 1)
+        high = min(i + diagonal + band, len(window))
+        for j in range(low, high + 1):
+            if read[i - 1] == window[j - 1] and read[i - 1] != 'N':
+                score = previous.get(j - 1, 0) + match
+            else:
+                score = previous.get(j - 1, 0) + mismatch
+            score = max(score, previous.get(j, 0) + gap, current.get(j - 1, 0) + gap, 0)
+            current[j] = score
+            if score > row_best[0]:
+                row_best = (score, j)
+        best.append(row_best)
+        previous = current
+    return best
+
+def split_read(read, left, right, left_diagonal, right_diagonal, band, min_score=0.5, match=2):
+    """
+    NAME: split_read()
+
+    PURPOSE:
+        Finds the position in a read where it jumps from the left window to the right
+        window. The read prefix is aligned to the left window and the reversed read
+        suffix to the reversed right window, and the split with the highest combined
+        score wins. Ties are resolved towards the leftmost split.
+
+        A split is only considered if both the prefix and the suffix score at least
+        min_score of a perfect match of their length, so a read that does not really
+        align to both windows gives no split.
+
+    :param read: The read
+    :type read: string
+    :param left: Reference window containing the left side of the split
+    :type left: string
+    :param right: Reference window containing the right side of the split
+    :type right: string
+    :param left_diagonal: Position in the left window where the read is expected to start
+    :type left_diagonal: int
+    :param right_diagonal: Distance from the end of the right window where the read is expected to end
+    :type right_diagonal: int
+    :param band: Number of cells computed on each side of the diagonal
+    :type band: int
+    :param min_score: Fraction of a perfect match score that both sides must reach (default: 0.5)
+    :type min_score: float
+    :param match: Score of a matching base (default: 2)
+    :type match: int
+    :return: A tuple of (score, end of the left alignment in the left window,
+             start of the right alignment in the right window), or None if either side does not align
+    :rtype: tuple
+    """
+    prefixes = _best_ends(read, left, left_diagonal, band, match=match)
+    suffixes = _best_ends(read[::-1], right[::-1], right_diagonal, band, match=match)
+    best = None
+    for i in range(1, len(read)):
+        prefix = prefixes[i]
+        suffix = suffixes[len(read) - i]
+        if prefix[1] is None or suffix[1] is None:
+            continue
+        if prefix[0] < min_score * match * i or suffix[0] < min_score * match * (len(read) - i):
+            continue
+        score = prefix[0] + suffix[0]
+        if best is None or score > best[0]:
+            best = (score, prefix[1], len(right) - suffix[1])
+    return best
+
+def refine_split(reference, record, best_start, best_end, reads, pad=100, band=10):
+    """
+    NAME: refine_split()
+
+    PURPOSE:
+        Refines a split found by kmer_finder.py to base-pair breakpoints. Only the
+        reference bases around the split are loaded from the packed reference. Each
+        supporting read is aligned in both orientations and the breakpoint pair that is
+        reported by the most reads is returned.
+
+    :param reference: The tuple returned by open_packed()
+    :type reference: tuple
+    :param record: The record number, as used by kmer_dict.py
+    :type record: int
+    :param best_start: Approximate end of the left side of the split
+    :type best_start: int
+    :param best_end: Approximate start of the right side of the split
+    :type best_end: int
+    :param reads: List of (read, match start, match end, leading, trailing) tuples, where match start
+                  and match end are the reference span of the read's k-mer matches, and leading and
+                  trailing are the number of read bases before the first and after the last matching k-mer
+    :type reads: list
+    :param pad: Distance either side of the split that the breakpoints are searched in (default: 100)
+    :type pad: int
+    :param band: Number of cells computed on each side of the alignment diagonal (default: 10)
+    :type band: int
+    :return: A tuple of (left breakpoint, right breakpoint, number of supporting reads), or None
+             if no read could be split
+    :rtype: tuple
+    """
+    if str(record) not in reference[0]['records']:
+        print("Record {r} is not in the packed reference, split ({s}, {e}) was not refined".format(
+            r=record, s=best_start, e=best_end))
+        return None
+
+    votes = {}
+    for read, match_start, match_end, leading, trailing in reads:
+        # Only reads that span the whole split can place both of its breakpoints
+        if match_start >= best_start or match_end <= best_end:
+            continue
+        best = None
+        # The ends of the read are placed on the reference from its matches, and in the reverse
+        # complement the bases before the first and after the last matching k-mer swap sides
+        for oriented, read_start, read_end in ((read, match_start - leading, match_end + trailing),
+                                               (reverse_complement(read), match_start - trailing, match_end + leading)):
+            # fetch() clips at the ends of the record, so the window starts are clipped the same way
+            left_start = max(read_start - band, 0)
+            left = fetch(reference, record, left_start, best_start + pad)
+            right_start = max(best_end - pad, 0)
+            right = fetch(reference, record, right_start, read_end + band)
+            left_diagonal = read_start - left_start
+            right_diagonal = right_start + len(right) - read_end
+            split = split_read(oriented, left, right, left_diagonal, right_diagonal, band)
+            if split and (best is None or split[0] > best[0]):
+                best = (split[0], left_start + split[1], right_start + split[2])
+        if best is None:
+            continue
+        breakpoints = (best[1], best[2])
+        votes[breakpoints] = votes.get(breakpoints, 0) + 1
+
+    if not votes:
+        return None
+    breakpoints = sorted(votes.items(), key=lambda kv: kv[1], reverse=True)[0]
+    return breakpoints[0][0], breakpoints[0][1], breakpoints[1]
@@ -0,0 +1,158 @@
+###########################
+## test_refine.py
+##
+## Checks for the packed reference and breakpoint refinement in refine.py
+###########################
+import random
+
+import pytest
+
+import refine
+
+def _write_fasta(path, records, width=60):
+    """
+    Writes (name, sequence) records to a FASTA file. width may be a list of line
+    widths, which are used in turn, to get uneven lines.
+    """
+    widths = width if isinstance(width, list) else [width]
+    with open(path, "w") as f:
+        for name, sequence in records:
+            f.write(">" + name + "\n")
+            position = 0
+            line = 0
+            while position < len(sequence):
+                step = widths[line % len(widths)]
+                f.write(sequence[position:position + step] + "\n")
+                position += step
+                line += 1
+
+def _pack(tmp_path, records, width=60):
+    fasta = str(tmp_path / "ref.fa")
+    prefix = str(tmp_path / "ref")
+    _write_fasta(fasta, records, width)
+    refine.write_packed(fasta, prefix, 15, 0, len(records))
+    return refine.open_packed(prefix, {}, 15)
+
+def _random_sequence(length, seed):
+    rng = random.Random(seed)
+    return "".join(rng.choice("ACGT") for _ in range(length))
+
+def _supporting_read(read, reference, kmer_length):
+    """
+    Builds the (read, match start, match end, leading, trailing) tuple the way
+    kmer_finder.py does, using canonical k-mers of a single reference sequence.
+    """
+    positions = {}
+    for position in range(len(reference) - kmer_length + 1):
+        k_mer = reference[position:position + kmer_length]
+        k_mer = min(k_mer, refine.reverse_complement(k_mer))
+        positions.setdefault(k_mer, []).append(position)
+    match_list = []
+    first_match = None
+    last_match = None
+    for number in range(len(read) - kmer_length + 1):
+        k_mer = read[number:number + kmer_length]
+        k_mer = min(k_mer, refine.reverse_complement(k_mer))
+        if k_mer in positions:
+            if first_match is None:
+                first_match = number
+            last_match = number
+            match_list += positions[k_mer]
+    match_list.sort()
+    return (read, match_list[0], match_list[-1] + kmer_length, first_match,
+            len(read) - last_match - kmer_length)
+
+def _mutate(read, position):
+    return read[:position] + "ACGT"[("ACGT".index(read[position]) + 1) % 4] + read[position + 1:]
+
+#################################
+def test_fetch_round_trip(tmp_path):
+    first = _random_sequence(1001, 1)
+    first = "NN" + first[2:300] + "N" * 13 + first[313:998] + "NNN"
+    second = _random_sequence(7, 2)
+    third = _random_sequence(523, 3)
+    reference = _pack(tmp_path, [("a", first), ("b", second), ("c", third)], width=[60, 61, 17])
+
+    for record, sequence in enumerate((first, second, third)):
+        assert refine.fetch(reference, record, 0, len(sequence)) == sequence
+        for start in range(0, len(sequence), 37):
+            for end in (start + 1, start + 4, start + 29):
+                assert refine.fetch(reference, record, start, end) == sequence[start:end]
+        # Regions are clipped to the record
+        assert refine.fetch(reference, record, -10, len(sequence) + 10) == sequence
+        assert refine.fetch(reference, record, len(sequence), len(sequence) + 5) == ""
+
+def test_fetch_empty_first_record(tmp_path):
+    fasta = str(tmp_path / "ref.fa")
+    prefix = str(tmp_path / "ref")
+    sequence = _random_sequence(50, 4)
+    with open(fasta, "w") as f:
+        f.write(">a\n>b\n" + sequence[:30] + "\n" + sequence[30:] + "\n")
+    refine.write_packed(fasta, prefix, 15, 0, 2)
+    reference = refine.open_packed(prefix, {}, 15)
+    assert refine.fetch(reference, 0, 0, 10) == ""
+    assert refine.fetch(reference, 1, 0, 50) == sequence
+
+def test_write_packed_rejects_shifted_layouts(tmp_path):
+    fasta = str(tmp_path / "ref.fa")
+    prefix = str(tmp_path / "ref")
+    for layout in (">a\nACGTACGTAA\n>b\n>c\nACGTTTGGCA\n", ">a\nACGTACGTAA\n\nACGTTTGGCA\n"):
+        with open(fasta, "w") as f:
+            f.write(layout)
+        with pytest.raises(ValueError):
+            refine.write_packed(fasta, prefix, 3, 0, 2)
+
+def test_open_packed_rejects_other_dictionary(tmp_path):
+    _pack(tmp_path, [("a", _random_sequence(100, 5))])
+    prefix = str(tmp_path / "ref")
+    with pytest.raises(ValueError):
+        refine.open_packed(prefix, {"1": [[0, 5]]}, 15)
+    with pytest.raises(ValueError):
+        refine.open_packed(prefix, {}, 11)
+
+#################################
+def _deletion_reads(sequence, mutation=None, count=20, length=150):
+    """
+    Reads that skip sequence[2000:3000], alternating between the forward strand and
+    the reverse complement, with an optional mismatch at a read position.
+    """
+    rng = random.Random(6)
+    reads = []
+    for number in range(count):
+        left = rng.randint(40, length - 40)
+        read = sequence[2000 - left:2000] + sequence[3000:3000 + length - left]
+        if mutation is not None:
+            read = _mutate(read, mutation)
+        if number % 2:
+            read = refine.reverse_complement(read)
+        reads.append(_supporting_read(read, sequence, 15))
+    return reads
+
+@pytest.mark.parametrize("mutation", [None, 0, 5, 13, 140, 149])
+def test_refine_split(tmp_path, mutation):
+    sequence = _random_sequence(6000, 7)
+    reference = _pack(tmp_path, [("a", sequence)])
+    reads = _deletion_reads(sequence, mutation)
+    # The coarse split only has to be within pad of the breakpoints
+    assert refine.refine_split(reference, 0, 1980, 3025, reads) == (2000, 3000, len(reads))
+
+def test_refine_split_unalignable_read(tmp_path):
+    sequence = _random_sequence(6000, 8)
+    reference = _pack(tmp_path, [("a", sequence)])
+    read = _random_sequence(150, 9)
+    assert refine.refine_split(reference, 0, 2000, 3000, [(read, 1950, 3050, 0, 0)]) is None
+
+def test_refine_split_missing_record(tmp_path):
+    reference = _pack(tmp_path, [("a", _random_sequence(100, 10))])
+    assert refine.refine_split(reference, 3, 20, 80, []) is None
+
+def test_split_read():
+    sequence = _random_sequence(400, 11)
+    left = sequence[:200]
+    right = sequence[200:]
+    read = sequence[150:180] + sequence[250:290]
+    # The read starts at 150 in the left window and ends 110 bases before the end of the right window
+    split = refine.split_read(read, left, right, 150, 110, 10)
+    assert split[1:] == (180, 50)
+    split = refine.split_read(refine.reverse_complement(read), left, right, 150, 110, 10)
+    assert split is None